@@ -64,8 +64,7 @@ def obj_fix(model: pyo.ConcreteModel, vars=[], activate=[], deactivate=[]):
     for var_name, var in model.component_map(pyo.Var, active=True).items():
         # fixing variables if they are specified by user
         if var_name in vars:
-            for i in list(var.keys()):
-                var[i].fix()
+            var.fix()
         # unfixing remaining variables
         else:
             var.unfix()
@@ -78,11 +77,24 @@ def obj_fix(model: pyo.ConcreteModel, vars=[], activate=[], deactivate=[]):
     return model
 
 
-def alter_nonlinear_cons(model: pyo.ConcreteModel, deactivate=False):
+# Function to collect the (bilinear) constraints that are not linear
+def nonlinear_cons(model: pyo.ConcreteModel):
+    cons = []
     for con in model.component_data_objects(ctype=pyo.Constraint, descend_into=True):
         degree = con.body.polynomial_degree()
         if degree != 0 and degree != 1:
             assert degree == 2
-            con.deactivate() if deactivate else con.activate()
+            cons.append(con)
+
+    return cons
+
+
+# Function to turn the nonlinear constraints off or on; the list from
+# nonlinear_cons can be passed in to avoid walking the model on every call
+def alter_nonlinear_cons(model: pyo.ConcreteModel, deactivate=False, cons=None):
+    if cons is None:
+        cons = nonlinear_cons(model)
+    for con in cons:
+        con.deactivate() if deactivate else con.activate()
 
     return model
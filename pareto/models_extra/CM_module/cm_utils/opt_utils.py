@@ -15,16 +15,223 @@ Functions used in run_infrastructure_analysis.py
 """
 
 from pareto.models_extra.CM_module.models.qcp_br import build_qcp_br
+import hashlib
+import os
+import pickle
+import numpy as np
+import warnings
 import pyomo.environ as pyo
+from pyomo.common.errors import InfeasibleConstraintException, IntervalException
+from pyomo.contrib.fbbt.fbbt import fbbt, FBBTException
+from pyomo.contrib.iis import write_iis
+from pyomo.core.expr.numeric_expr import LinearExpression
+from pyomo.core.expr.visitor import identify_variables
 from pareto.models_extra.CM_module.cm_utils.gen_utils import (
-    obj_fix,
     alter_nonlinear_cons,
+    nonlinear_cons,
 )
 from pareto.utilities.solvers import get_solver
 
+# models with fewer variables plus constraints than this skip the linear
+# flow initialization in cost_optimal
+FLOW_LP_THRESHOLD = 5000
 
-def max_theoretical_recovery_flow_opt(
-    model, desal_unit: str, cm_name: str, desired_cm_conc, tee=False
+# problems with fewer generation entries than this use the pure Python
+# greedy rule, larger ones the NumPy version (measured crossover ~100)
+GREEDY_NUMPY_MIN_SIZE = 100
+
+# variable bounds found by FBBT, keyed by the input data and the model
+# structure; only the most recent models are kept
+_FBBT_CACHE_SIZE = 8
+_FBBT_BOUNDS = {}
+
+
+def _greedy_python(f, c, desired_cm_conc):
+    """
+    Pure Python version of the sort-then-fill rule, used for small problems
+    where the NumPy setup costs more than the loop.
+    """
+    cumulative_f = 0.0
+    cumulative_cm = 0.0
+    for fi, ci in sorted(zip(f, c), key=lambda x: -x[1]):
+        # sources without flow do not contribute
+        if fi <= 0:
+            continue
+        if cumulative_cm + fi * ci >= desired_cm_conc * (cumulative_f + fi):
+            cumulative_f += fi
+            cumulative_cm += fi * ci
+        else:
+            # only the fraction of this flow that brings the mixed
+            # concentration exactly down to the desired level is taken
+            return cumulative_f + (cumulative_cm - desired_cm_conc * cumulative_f) / (
+                desired_cm_conc - ci
+            )
+    return cumulative_f
+
+
+def _greedy_numpy(f, c, desired_cm_conc):
+    """
+    Vectorized version of the sort-then-fill rule.
+    """
+    f = np.asarray(f, dtype=np.float64)
+    c = np.asarray(c, dtype=np.float64)
+
+    # sources without flow do not contribute and would make the ratios undefined
+    c = c[f > 0]
+    f = f[f > 0]
+
+    order = np.argsort(-c, kind="stable")
+    f, c = f[order], c[order]
+    cumulative_f = np.cumsum(f)
+    cumulative_cm = np.cumsum(f * c)
+
+    # the running concentration is non-increasing, so the first source that
+    # pushes it below the desired level can be found with a binary search
+    ratio = cumulative_cm / cumulative_f
+    idx = np.searchsorted(-ratio, -desired_cm_conc, side="right")
+    if idx == len(f):
+        return float(cumulative_f[-1]) if len(f) else 0.0
+
+    # the full flows before idx are taken, plus the fraction of flow idx
+    # that brings the mixed concentration exactly down to the desired level
+    prev_f = cumulative_f[idx - 1] if idx > 0 else 0.0
+    prev_cm = cumulative_cm[idx - 1] if idx > 0 else 0.0
+    ff = (prev_cm - desired_cm_conc * prev_f) / (desired_cm_conc - c[idx])
+    return float(prev_f + ff)
+
+
+def _greedy_recovery_flow(model, cm_name: str, desired_cm_conc):
+    """
+    Sort-then-fill solution of the recovery flow problem: the flows are
+    taken in order of decreasing concentration until the mixed
+    concentration reaches the desired level; the last flow is only
+    taken partially. Returns the flow at the inlet of the treatment unit.
+    """
+    # p_FGen and p_CGen are immutable, so their values are pulled out once
+    # instead of going through pyo.value for every index
+    flow_gen = model.p_FGen.extract_values()
+    conc_gen = model.p_CGen.extract_values()
+    f = [flow_gen[k] * 7 for k in flow_gen]
+    c = [conc_gen[k[0], cm_name, k[1]] for k in flow_gen]
+
+    if len(f) < GREEDY_NUMPY_MIN_SIZE:
+        return _greedy_python(f, c, desired_cm_conc)
+    return _greedy_numpy(f, c, desired_cm_conc)
+
+
+def _iis_solver_available():
+    """
+    Checks whether one of the solvers write_iis supports (CPLEX, Gurobi,
+    Xpress) is available through its persistent interface.
+    """
+    return any(
+        pyo.SolverFactory(f"{solver}_persistent").available(exception_flag=False)
+        for solver in ["cplex", "gurobi", "xpress"]
+    )
+
+
+def _is_linear(model):
+    """
+    Checks whether the active constraints and objectives are all linear.
+    """
+    for ctype in [pyo.Constraint, pyo.Objective]:
+        for comp in model.component_data_objects(ctype, active=True, descend_into=True):
+            expr = comp.body if ctype is pyo.Constraint else comp.expr
+            if expr.polynomial_degree() not in (0, 1):
+                return False
+    return True
+
+
+def _dump_infeasible(model, name, dump_dir):
+    """
+    Writes an infeasible model to dump_dir for offline inspection. For linear
+    models an IIS is written to <name>_iis.ilp if CPLEX, Gurobi or Xpress is
+    available. Otherwise, and always for nonlinear models, where the solver
+    may only have stopped at a locally infeasible point, the model is written
+    to <name>_infeasible.nl, with the variable and constraint names in
+    <name>_infeasible.col and .row.
+    """
+    linear = _is_linear(model)
+    if linear and _iis_solver_available():
+        fname = write_iis(model, os.path.join(dump_dir, f"{name}_iis.ilp"))
+        print(f"   ... {name} is infeasible, see {fname}")
+        return fname
+
+    fname = os.path.join(dump_dir, f"{name}_infeasible.nl")
+    model.write(fname, io_options={"symbolic_solver_labels": True})
+    reason = (
+        "no IIS-capable solver (CPLEX, Gurobi or Xpress) is available"
+        if linear
+        else "no IIS is computed for nonlinear models"
+    )
+    print(f"   ... {name} is infeasible, {reason}, see {fname}")
+    return fname
+
+
+def _solve(opt, model, name, tee=False, dump_dir=None):
+    """
+    Solves the model and loads the solution, raising if the solve was not
+    optimal. If dump_dir is given and the solver reports the problem as
+    infeasible (or infeasible or unbounded), the model is written to
+    dump_dir first, see _dump_infeasible, so the failing solve does not
+    have to be rerun.
+    """
+    status = opt.solve(model, tee=tee, load_solutions=False)
+    infeasible = status.solver.termination_condition in [
+        pyo.TerminationCondition.infeasible,
+        pyo.TerminationCondition.infeasibleOrUnbounded,
+    ]
+    if infeasible and dump_dir is not None:
+        _dump_infeasible(model, name, dump_dir)
+    pyo.assert_optimal_termination(status)
+    model.solutions.load_from(status)
+    return status
+
+
+def _recovery_flow_lp(model, cm_name: str, desired_cm_conc, tee=False, dump_dir=None):
+    """
+    LP formulation of the recovery flow problem, solved with a
+    numerical solver. Returns the flow at the inlet of the treatment unit.
+    """
+    # the generation data is looked up once and the LP is indexed by position
+    flow_gen = model.p_FGen.extract_values()
+    conc_gen = model.p_CGen.extract_values()
+    keys = list(flow_gen)
+    c_vals = [conc_gen[k[0], cm_name, k[1]] for k in keys]
+
+    mm = pyo.ConcreteModel()
+    mm.S = pyo.Set(initialize=range(len(keys)))
+    bounds = {i: (0, flow_gen[k] * 7) for i, k in enumerate(keys)}
+    mm.F = pyo.Var(mm.S, bounds=bounds)
+    mm.cumulative_F = pyo.Var(bounds=(10, None))
+    # the sums are created directly as flat linear expressions
+    flow_vars = [mm.F[i] for i in mm.S]
+    total_flow = LinearExpression(
+        constant=0.0, linear_coefs=[1.0] * len(flow_vars), linear_vars=flow_vars
+    )
+    mm.cumulative_F_con = pyo.Constraint(expr=mm.cumulative_F == total_flow)
+    mm.obj = pyo.Objective(expr=mm.cumulative_F, sense=pyo.maximize)
+    mm.total_li = pyo.Expression(
+        expr=LinearExpression(constant=0.0, linear_coefs=c_vals, linear_vars=flow_vars)
+    )
+    mm.quality_con = pyo.Constraint(
+        expr=mm.total_li >= desired_cm_conc * mm.cumulative_F
+    )
+
+    # this is a pure LP, so a dedicated LP solver is used when one is available
+    opt = get_solver("gurobi_direct", "appsi_highs", "cbc", "glpk", "ipopt")
+    _solve(opt, mm, "recovery_flow_lp", tee=tee, dump_dir=dump_dir)
+    return pyo.value(mm.cumulative_F)
+
+
+def max_theoretical_recovery_flow(
+    model,
+    desal_unit: str,
+    cm_name: str,
+    desired_cm_conc,
+    verify=False,
+    tee=False,
+    dump_dir=None,
 ):
     """
     This function computes the largest flow possible to
@@ -36,6 +243,13 @@ def max_theoretical_recovery_flow_opt(
     treatment_unit: name of desalination unit
     cm_name: name of critical mineral to be assessed
     desired_cm_conc: minimum CM concentration requirement
+    verify: also solve the LP formulation and check that both results agree
+    tee: show the solver output when verify is True
+    dump_dir: directory to write the LP to if it is infeasible when verify is True
+
+    Raises a RuntimeError if the desired concentration cannot be reached
+    with a total flow of at least 10, or if verify is True and the LP flow
+    does not match.
     """
     assert cm_name in model.s_Q, f"{cm_name} is not a valid component to the base model"
     assert (
@@ -46,30 +260,317 @@ def max_theoretical_recovery_flow_opt(
     # desired concentration at the inlet - this will be corrected at the end
     desired_cm_conc = desired_cm_conc * (1 - alphaW)
 
-    mm = pyo.ConcreteModel()
-    mm.S = list(model.p_FGen.index_set())
-    bounds = {k: (0, model.p_FGen[k] * 7) for k in mm.S}
-    mm.F = pyo.Var(mm.S, bounds=bounds)
-    mm.cumulative_F = pyo.Var(bounds=(10, None))
-    mm.cumulative_F_con = pyo.Constraint(
-        expr=mm.cumulative_F == sum(mm.F[t] for t in mm.S)
-    )
-    mm.obj = pyo.Objective(expr=mm.cumulative_F, sense=pyo.maximize)
-    mm.total_li = pyo.Expression(
-        expr=sum(mm.F[t] * model.p_CGen[t[0], cm_name, t[1]] for t in mm.S)
+    # The LP max sum(F) s.t. sum(F * (C - desired)) >= 0, 0 <= F <= 7 * FGen
+    # has a single coupling constraint and box bounds on the variables, i.e. it
+    # is a fractional knapsack, which is solved optimally by the sort-then-fill
+    # rule. The LP is therefore only solved when explicitly asked to verify.
+    cumulative_f = _greedy_recovery_flow(model, cm_name, desired_cm_conc)
+    # the LP requires a total flow of at least 10, so targets that cannot be
+    # reached raise as they did when the LP was always solved
+    if cumulative_f < 10:
+        raise RuntimeError(
+            f"a {cm_name} concentration of {desired_cm_conc / (1 - alphaW)} "
+            "cannot be reached with a recovery flow of at least 10"
+        )
+    if verify:
+        lp_cumulative_f = _recovery_flow_lp(
+            model, cm_name, desired_cm_conc, tee=tee, dump_dir=dump_dir
+        )
+        if abs(cumulative_f - lp_cumulative_f) > 1e-4 * max(1, abs(lp_cumulative_f)):
+            raise RuntimeError(
+                f"greedy flow {cumulative_f} does not match LP flow {lp_cumulative_f}"
+            )
+    return cumulative_f * (1 - alphaW)
+
+
+def max_theoretical_recovery_flow_opt(
+    model, desal_unit: str, cm_name: str, desired_cm_conc, tee=False, dump_dir=None
+):
+    """
+    Deprecated: use max_theoretical_recovery_flow instead.
+    This runs the same computation and verifies it against the LP formulation.
+    """
+    warnings.warn(
+        "max_theoretical_recovery_flow_opt is deprecated, "
+        "use max_theoretical_recovery_flow instead",
+        DeprecationWarning,
     )
-    mm.quality_con = pyo.Constraint(
-        expr=mm.total_li >= desired_cm_conc * mm.cumulative_F
+    return max_theoretical_recovery_flow(
+        model,
+        desal_unit=desal_unit,
+        cm_name=cm_name,
+        desired_cm_conc=desired_cm_conc,
+        verify=True,
+        tee=tee,
+        dump_dir=dump_dir,
     )
 
-    status = get_solver("ipopt").solve(mm, tee=tee)
-    pyo.assert_optimal_termination(status)
-    return pyo.value(mm.cumulative_F) * (1 - alphaW)
+
+def _get_ipopt():
+    """
+    Returns an IPOPT solver object for the two-phase solves. The persistent
+    APPSI interface is preferred since it keeps the NL representation of the
+    model between solves and only updates what changed (e.g. which
+    constraints are active); it needs the compiled APPSI extensions, so the
+    standard interface is used when it is not available.
+    """
+    return get_solver("appsi_ipopt", "ipopt")
 
 
-def max_recovery_with_infrastructure(data, tee=False):
+def _add_warm_start_suffixes(model):
+    """
+    Declares the suffixes used to pass the IPOPT multipliers
+    from one solve to the next.
+    """
+    model.ipopt_zL_out = pyo.Suffix(direction=pyo.Suffix.IMPORT)
+    model.ipopt_zU_out = pyo.Suffix(direction=pyo.Suffix.IMPORT)
+    model.ipopt_zL_in = pyo.Suffix(direction=pyo.Suffix.EXPORT)
+    model.ipopt_zU_in = pyo.Suffix(direction=pyo.Suffix.EXPORT)
+    model.dual = pyo.Suffix(direction=pyo.Suffix.IMPORT_EXPORT)
+
+
+def _presolve(model):
+    """
+    Fixes the variables that are determined by the active constraints on
+    their own, i.e. flows forced to zero and concentrations set to a given
+    value, and deactivates the constraints this makes redundant. Fixed
+    variables are written as constants, which shrinks the NLP passed to IPOPT.
+    The changes are made in place and are not undone after the solve.
+    """
+    pyo.TransformationFactory("contrib.propagate_zero_sum").apply_to(model)
+    pyo.TransformationFactory("contrib.deactivate_trivial_constraints").apply_to(model)
+    pyo.TransformationFactory("contrib.constraints_to_var_bounds").apply_to(model)
+    pyo.TransformationFactory("contrib.detect_fixed_vars").apply_to(model)
+    return model
+
+
+def _data_key(data):
+    """
+    Returns a stable key for the input data, used to reuse results
+    across calls on the same data.
+    """
+    return hashlib.blake2b(pickle.dumps(data, protocol=5)).digest()
+
+
+def _restore_bounds(variables, bounds):
+    """
+    Sets the (lb, ub) bounds on the variables, in the same order.
+    """
+    for var, (lb, ub) in zip(variables, bounds):
+        var.setlb(lb)
+        var.setub(ub)
+
+
+def _model_key(model, variables):
+    """
+    Returns a key for the structure the FBBT bounds depend on: the active
+    constraints and the bounds and fixed values of the variables.
+    """
+    active = [
+        con.name
+        for con in model.component_data_objects(
+            pyo.Constraint, active=True, descend_into=True
+        )
+    ]
+    state = [
+        (var.name, var.lb, var.ub, var.fixed, var.value if var.fixed else None)
+        for var in variables
+    ]
+    return hashlib.blake2b(pickle.dumps((active, state), protocol=5)).digest()
+
+
+def _tighten_bounds(model, key):
+    """
+    Tightens the variable bounds with feasibility-based bounds tightening
+    (FBBT) over the active constraints. The bounds of the last
+    _FBBT_CACHE_SIZE models are cached under key together with the active
+    constraints and variable bounds, so repeated calls on the same data and
+    model skip the FBBT pass.
+    """
+    variables = list(model.component_data_objects(pyo.Var, descend_into=True))
+    key = (key, _model_key(model, variables))
+    cached = _FBBT_BOUNDS.get(key)
+    if cached is not None:
+        for var in variables:
+            var.setlb(cached[var.name][0])
+            var.setub(cached[var.name][1])
+        return model
+
+    # fbbt tightens the bounds in place, so they are reset if it stops early
+    original = [(var.lb, var.ub) for var in variables]
+    try:
+        fbbt(model, max_iter=10, improvement_tol=1e-4)
+    except InfeasibleConstraintException:
+        # the infeasibility is left to be reported by the solver
+        _restore_bounds(variables, original)
+        return model
+    except (FBBTException, IntervalException) as err:
+        # unsupported expression types are skipped by fbbt itself, but some
+        # bounds (e.g. fractional powers of negative variables) raise instead
+        print(f"   ... skipping bound tightening: {err}")
+        _restore_bounds(variables, original)
+        return model
+
+    if len(_FBBT_BOUNDS) >= _FBBT_CACHE_SIZE:
+        del _FBBT_BOUNDS[next(iter(_FBBT_BOUNDS))]
+    _FBBT_BOUNDS[key] = {var.name: (var.lb, var.ub) for var in variables}
+    return model
+
+
+def _concentration_cons(model):
+    """
+    Pairs each concentration balance of the model with the concentration
+    it determines: the node concentration for the mixer/splitter, storage
+    and treatment inlet balances, and the outlet concentration for the
+    treated/concentrated water balances.
+    """
+    pairs = []
+    for con in [model.MSconc, model.TINconc, model.Sconc]:
+        for idx, con_data in con.items():
+            pairs.append((model.v_C[idx], con_data))
+
+    # the treatment outlet balances are constraint lists, so the outlet
+    # concentration is looked up in the expression
+    outlets = model.s_NTTW | model.s_NTCW
+    for con in [model.NTTWconc, model.NTCWconc, model.NTSrcconc]:
+        for con_data in con.values():
+            for var in identify_variables(con_data.body):
+                if var.parent_component() is model.v_C and var.index()[0] in outlets:
+                    pairs.append((var, con_data))
+                    break
+    return pairs
+
+
+def _init_concentrations(model, max_sweeps=10, tol=1e-6):
+    """
+    Initializes the concentrations by solving the concentration balances
+    of the model in turn for the concentration they determine, with the
+    flows and inventories of the linear flow solution, so the bilinear
+    solve does not start from the default concentrations. The balances are
+    linear in that concentration, so each one is solved from two
+    evaluations. Fixed variables are left untouched, as are concentrations
+    whose balance carries no flow.
+    """
+    pairs = [
+        (var, con, pyo.value(con.upper))
+        for var, con in _concentration_cons(model)
+        if con.active and not var.fixed
+    ]
+
+    for _ in range(max_sweeps):
+        change = 0
+        for var, con, rhs in pairs:
+            old = var.value
+            var.set_value(0, skip_validation=True)
+            intercept = pyo.value(con.body) - rhs
+            var.set_value(1, skip_validation=True)
+            slope = pyo.value(con.body) - rhs - intercept
+            if abs(slope) < 1e-10:
+                var.set_value(old, skip_validation=True)
+                continue
+
+            value = -intercept / slope
+            lb, ub = var.bounds
+            value = max(value, lb) if lb is not None else value
+            value = min(value, ub) if ub is not None else value
+            var.set_value(value)
+            change += abs(value - old) if old is not None else abs(value)
+        if change < tol:
+            break
+
+    return model
+
+
+def _warm_start(opt, model):
+    """
+    Sets up the next IPOPT solve to start from the primal-dual
+    point of the previous solve stored on the model.
+    """
+    # the persistent interface does not exchange the bound multipliers, in which
+    # case IPOPT already starts from the primal values loaded on the model
+    if len(model.ipopt_zL_out) == 0 and len(model.ipopt_zU_out) == 0:
+        return opt
+
+    # multipliers of variables fixed or constraints deactivated since the
+    # last solve are not exported
+    for var, val in model.ipopt_zL_out.items():
+        if not var.fixed:
+            model.ipopt_zL_in[var] = val
+    for var, val in model.ipopt_zU_out.items():
+        if not var.fixed:
+            model.ipopt_zU_in[var] = val
+    for con in list(model.dual.keys()):
+        if not con.active:
+            model.dual.clear_value(con)
+
+    opt.options["warm_start_init_point"] = "yes"
+    opt.options["warm_start_bound_push"] = 1e-9
+    opt.options["warm_start_mult_bound_push"] = 1e-9
+    opt.options["mu_init"] = 1e-6
+    return opt
+
+
+def _set_linear_solver(opt, linear_solver=None):
+    """
+    Sets the linear solver used by IPOPT, keeping the default of the IPOPT
+    build if linear_solver is None. MA57 is run with automatic scaling, which
+    copes better with the ill-conditioning from the bilinear terms, and is
+    only selected if the IPOPT build has it. The pivot tolerance is raised
+    from the default 1e-8 to 1e-2 either way.
+    """
+    if linear_solver == "ma57":
+        if opt.has_linear_solver("ma57"):
+            opt.options["linear_solver"] = "ma57"
+            opt.options["ma57_automatic_scaling"] = "yes"
+            opt.options["ma57_pivtol"] = 1e-2
+            return opt
+        print("   ... MA57 is not available, keeping the default linear solver")
+    elif linear_solver is not None:
+        opt.options["linear_solver"] = linear_solver
+    opt.options["ma27_pivtol"] = 1e-2
+    return opt
+
+
+def max_recovery_with_infrastructure(
+    data,
+    tee=False,
+    presolve=False,
+    tighten_bounds=False,
+    init_concentrations=False,
+    warm_start=False,
+    linear_solver=None,
+    mu_strategy=None,
+    dump_dir=None,
+):
+    """
+    Solves for the maximum critical mineral revenue with the existing
+    infrastructure, starting from a linear flow solution. The options
+    preparing the bilinear solve are off by default, which solves it from
+    the primal point of the linear flow solution.
+
+    Arguments:
+    data: input data for the qcp base model
+    tee: show the solver output
+    presolve: fix the variables determined by the active constraints on
+        their own before the bilinear solve, see _presolve. The returned
+        model keeps these fixings, the bounds taken from constraints and
+        the deactivated trivial constraints.
+    tighten_bounds: tighten the variable bounds with FBBT before the
+        bilinear solve
+    init_concentrations: initialize the concentrations from the flows of
+        the linear flow solution
+    warm_start: pass the IPOPT multipliers of the linear flow solve to the
+        bilinear solve
+    linear_solver: IPOPT linear solver for the bilinear solve, see
+        _set_linear_solver; the default of the IPOPT build is used if None
+    mu_strategy: IPOPT barrier parameter update for the bilinear solve,
+        e.g. "adaptive"; the IPOPT default is used if None
+    dump_dir: directory to write the model to if a solve is infeasible
+    """
     # build the model from the loaded data
     model = build_qcp_br(data)
+    if warm_start:
+        _add_warm_start_suffixes(model)
 
     ###
     # First, we solve a flow-based LP without any concentration variables
@@ -79,36 +580,45 @@ def max_recovery_with_infrastructure(data, tee=False):
     model.treatment_only_obj.activate()
 
     # create lists of constraints involving concentrations and all flow / inventory variables
-    model = alter_nonlinear_cons(model, deactivate=True)
+    nonlinear = nonlinear_cons(model)
+    model = alter_nonlinear_cons(model, deactivate=True, cons=nonlinear)
 
     # Solve the linear flow model
     print("   ... running linear flow model")
-    opt = get_solver("ipopt")
-    status = opt.solve(model, tee=tee)
-
+    opt = _get_ipopt()
     # terminating script early if optimal solution not found
-    pyo.assert_optimal_termination(status)
+    _solve(opt, model, "max_recovery_flow_lp", tee=tee, dump_dir=dump_dir)
 
     ###
     # Bilinear NLP
     ###
 
     # unfixing all the initialized variables
-    model = alter_nonlinear_cons(model, deactivate=False)
+    model = alter_nonlinear_cons(model, deactivate=False, cons=nonlinear)
 
     # solve for the maximum possible recovery revenue given this infrastructure
     model.TINflow.deactivate()
-    for k in model.Dflow:
-        if k[0].endswith("TW") or k[0].endswith("CW"):
-            model.Dflow[k].deactivate()
+    # the node names are checked once and all time periods are deactivated
+    # through a slice, rather than checking every (node, time) index
+    for n in model.s_ND:
+        if n.endswith("TW") or n.endswith("CW"):
+            model.Dflow[n, :].deactivate()
 
-    # running bilinear model
+    # running bilinear model, starting from the linear flow solution
     print("   ... running bilinear model")
-    opt = get_solver("ipopt")
-    opt.options["ma27_pivtol"] = 1e-2
+    if presolve:
+        model = _presolve(model)
+    if tighten_bounds:
+        model = _tighten_bounds(model, _data_key(data))
+    if init_concentrations:
+        model = _init_concentrations(model)
+    if warm_start:
+        opt = _warm_start(opt, model)
+    opt = _set_linear_solver(opt, linear_solver)
+    if mu_strategy is not None:
+        opt.options["mu_strategy"] = mu_strategy
     opt.options["tol"] = 1e-6
-    status = opt.solve(model, tee=tee)
-    pyo.assert_optimal_termination(status)
+    _solve(opt, model, "max_recovery_bilinear", tee=tee, dump_dir=dump_dir)
     print(
         "Max critical mineral revenue with existing infrastructure:",
         pyo.value(model.treat_rev),
@@ -116,37 +626,59 @@ def max_recovery_with_infrastructure(data, tee=False):
     return model
 
 
-def cost_optimal(data, tee=False):
+def cost_optimal(data, tee=False, presolve=False, warm_start=False, dump_dir=None):
+    """
+    Solves for the cost optimal solution, starting from a linear
+    flow solution if the model is large enough.
+
+    Arguments:
+    data: input data for the qcp base model
+    tee: show the solver output
+    presolve: fix the variables determined by the active constraints on
+        their own before the bilinear solve, see _presolve. The returned
+        model keeps these fixings, the bounds taken from constraints and
+        the deactivated trivial constraints.
+    warm_start: pass the IPOPT multipliers of the linear flow solve to the
+        bilinear solve; the bilinear solve is only warm started if there was
+        a linear flow solve
+    dump_dir: directory to write the model to if a solve is infeasible
+    """
     # build the model from the loaded data
     model = build_qcp_br(data)
+    if warm_start:
+        _add_warm_start_suffixes(model)
+    opt = _get_ipopt()
 
     ###
-    # First, we solve a flow-based LP without any concentration variables
+    # First, we solve a flow-based LP without any concentration variables.
+    # For small models the initialization costs more than it saves, so the
+    # bilinear NLP is solved directly.
     ###
+    if model.nvariables() + model.nconstraints() < FLOW_LP_THRESHOLD:
+        print("   ... skipping linear flow model for small model")
+    else:
+        # create lists of constraints involving concentrations and all flow / inventory variables
+        nonlinear = nonlinear_cons(model)
+        model = alter_nonlinear_cons(model, deactivate=True, cons=nonlinear)
 
-    # create lists of constraints involving concentrations and all flow / inventory variables
+        # Solve the linear flow model
+        print("   ... running linear flow model")
+        # terminating script early if optimal solution not found
+        _solve(opt, model, "cost_optimal_flow_lp", tee=tee, dump_dir=dump_dir)
 
-    model = alter_nonlinear_cons(model, deactivate=True)
-
-    # Solve the linear flow model
-    print("   ... running linear flow model")
-    opt = get_solver("ipopt")
-    status = opt.solve(model, tee=tee)
-
-    # terminating script early if optimal solution not found
-    pyo.assert_optimal_termination(status)
+        # unfixing all the initialized variables
+        model = alter_nonlinear_cons(model, deactivate=False, cons=nonlinear)
 
     ###
     # Bilinear NLP
     ###
 
-    # unfixing all the initialized variables
-    model = alter_nonlinear_cons(model, deactivate=False)
-
-    # running bilinear model
+    # running bilinear model, starting from the linear flow solution if there is one
     print("   ... running bilinear model")
-    opt = get_solver("ipopt")
+    if presolve:
+        model = _presolve(model)
+    if warm_start:
+        opt = _warm_start(opt, model)
     opt.options["max_iter"] = 10000
-    status = opt.solve(model, tee=tee)
-    pyo.assert_optimal_termination(status)
+    _solve(opt, model, "cost_optimal_bilinear", tee=tee, dump_dir=dump_dir)
     return model
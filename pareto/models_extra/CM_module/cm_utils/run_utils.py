@@ -24,6 +24,7 @@ from pareto.utilities.get_data import get_data
 from pareto.models_extra.CM_module.cm_utils.gen_utils import (
     report_results_to_excel,
     alter_nonlinear_cons,
+    nonlinear_cons,
 )
 from pareto.models_extra.CM_module.cm_utils.data_parser import data_parser, _tolist
 
@@ -321,7 +322,8 @@ def solving(
     # # ------------------------------Flow based LP------------------------------------
 
     # fixing concentration and making the model linear
-    model = alter_nonlinear_cons(model, deactivate=True)
+    nonlinear = nonlinear_cons(model)
+    model = alter_nonlinear_cons(model, deactivate=True, cons=nonlinear)
 
     # running linear flow model
     print("\nDeveloping an initialization...")
@@ -334,7 +336,7 @@ def solving(
         )
 
     # unfixing all the initialized variables
-    model = alter_nonlinear_cons(model, deactivate=False)
+    model = alter_nonlinear_cons(model, deactivate=False, cons=nonlinear)
 
     # running bilinear model
     print("\nSolving bilinear problem...")
@@ -20,7 +20,7 @@ import pyomo.environ as pyo
 from pareto.utilities.get_data import get_data
 from pareto.models_extra.CM_module.cm_utils.gen_utils import report_results_to_excel
 from pareto.models_extra.CM_module.cm_utils.opt_utils import (
-    max_theoretical_recovery_flow_opt,
+    max_theoretical_recovery_flow,
     cost_optimal,
     max_recovery_with_infrastructure,
 )
@@ -49,7 +49,7 @@ print("--- Running max treatment with infrastructure ---")
 max_inf_model = max_recovery_with_infrastructure(data)
 
 print("--- Runnning max theoretical treatment revenue ---")
-max_recovery = max_theoretical_recovery_flow_opt(
+max_recovery = max_theoretical_recovery_flow(
     model, desal_unit="R01_IN", cm_name="Li", desired_cm_conc=100
 )
 
@@ -21,16 +21,32 @@ from pareto.models_extra.CM_module.set_param_list import (
     set_list,
     parameter_list,
 )
+from pareto.models_extra.CM_module.cm_utils import opt_utils
 from pareto.models_extra.CM_module.cm_utils.opt_utils import (
-    max_theoretical_recovery_flow_opt,
+    max_theoretical_recovery_flow,
     cost_optimal,
     max_recovery_with_infrastructure,
+    _greedy_python,
+    _greedy_numpy,
+    _recovery_flow_lp,
+    _tighten_bounds,
+    _init_concentrations,
+    _presolve,
+    _warm_start,
+    _add_warm_start_suffixes,
+    _set_linear_solver,
+    _dump_infeasible,
+    _FBBT_CACHE_SIZE,
 )
 
 from pareto.models_extra.CM_module.cm_utils.data_parser import data_parser
 from pareto.utilities.get_data import get_data
 from pareto.models_extra.CM_module.cm_utils.run_utils import node_rerun
-from pareto.models_extra.CM_module.cm_utils.gen_utils import report_results_to_excel
+from pareto.models_extra.CM_module.cm_utils.gen_utils import (
+    report_results_to_excel,
+    alter_nonlinear_cons,
+    nonlinear_cons,
+)
 from pareto.utilities.solvers import get_solver
 
 
@@ -90,6 +106,21 @@ class TestAddFeatures:
         data = data_parser(df_sets, df_parameters)
         return data, df_sets, df_parameters
 
+    def linear_flow_model(self, data):
+        """
+        Solves the linear flow model, as in max_recovery_with_infrastructure,
+        and reactivates the nonlinear constraints
+        """
+        model = build_qcp_br(data)
+        model.obj.deactivate()
+        model.br_obj.deactivate()
+        model.treatment_only_obj.activate()
+        nonlinear = nonlinear_cons(model)
+        model = alter_nonlinear_cons(model, deactivate=True, cons=nonlinear)
+        status = get_solver("appsi_highs", "ipopt").solve(model)
+        pyo.assert_optimal_termination(status)
+        return alter_nonlinear_cons(model, deactivate=False, cons=nonlinear)
+
     def test_infra_analysis(self):
         data, _, _ = self.obtain_data()
         print("--- Running cost optimal solution ---")
@@ -99,7 +130,7 @@ class TestAddFeatures:
         max_inf_model = max_recovery_with_infrastructure(data)
 
         print("--- Runnning max theoretical treatment revenue ---")
-        max_recovery = max_theoretical_recovery_flow_opt(
+        max_recovery = max_theoretical_recovery_flow(
             model, desal_unit="R01_IN", desired_cm_conc=100, cm_name="Li"
         )
 
@@ -107,6 +138,218 @@ class TestAddFeatures:
 
         assert max_recovery >= max_w_infra
 
+    def test_bilinear_options(self):
+        data, _, _ = self.obtain_data()
+        options = dict(presolve=True, warm_start=True)
+
+        # the prepared bilinear solves must reach the same objectives
+        cold_model = cost_optimal(data)
+        warm_model = cost_optimal(data, **options)
+        assert pyo.value(warm_model.br_obj) == pytest.approx(
+            pyo.value(cold_model.br_obj), rel=1e-4
+        )
+
+        options.update(
+            tighten_bounds=True,
+            init_concentrations=True,
+            linear_solver="ma57",
+            mu_strategy="adaptive",
+        )
+        cold_model = max_recovery_with_infrastructure(data)
+        warm_model = max_recovery_with_infrastructure(data, **options)
+        assert pyo.value(warm_model.treat_rev) == pytest.approx(
+            pyo.value(cold_model.treat_rev), rel=1e-4
+        )
+
+    def test_presolve(self):
+        data, _, _ = self.obtain_data()
+        model = self.linear_flow_model(data)
+        variables = list(model.component_data_objects(pyo.Var, descend_into=True))
+        values = [v.value for v in variables]
+        model = _presolve(model)
+
+        fixed = [(v, val) for v, val in zip(variables, values) if v.fixed]
+        assert len(fixed) > 0
+        # the variables are fixed at the linear flow solution
+        for v, val in fixed:
+            assert v.value == pytest.approx(val, abs=1e-6)
+
+    def test_warm_start(self):
+        m = pyo.ConcreteModel()
+        m.x = pyo.Var(bounds=(0, 1))
+        m.y = pyo.Var(bounds=(0, 1))
+        m.c = pyo.Constraint(expr=m.x + m.y <= 1)
+        m.d = pyo.Constraint(expr=m.x >= 0.5)
+        _add_warm_start_suffixes(m)
+        m.ipopt_zL_out[m.x] = 1.0
+        m.ipopt_zL_out[m.y] = 2.0
+        m.ipopt_zU_out[m.x] = 3.0
+        m.dual[m.c] = 4.0
+        m.dual[m.d] = 5.0
+
+        # y is fixed and d deactivated after the previous solve
+        m.y.fix(0)
+        m.d.deactivate()
+        opt = _warm_start(pyo.SolverFactory("ipopt"), m)
+
+        assert list(m.ipopt_zL_in.items()) == [(m.x, 1.0)]
+        assert list(m.ipopt_zU_in.items()) == [(m.x, 3.0)]
+        assert list(m.dual.items()) == [(m.c, 4.0)]
+        assert opt.options["warm_start_init_point"] == "yes"
+
+    def test_set_linear_solver(self):
+        # the default linear solver keeps the previous pivot tolerance
+        opt = _set_linear_solver(pyo.SolverFactory("ipopt"))
+        assert "linear_solver" not in opt.options
+        assert opt.options["ma27_pivtol"] == 1e-2
+
+        opt = _set_linear_solver(pyo.SolverFactory("ipopt"), "mumps")
+        assert opt.options["linear_solver"] == "mumps"
+
+    def test_cost_optimal_small_model(self, monkeypatch, capsys):
+        data, _, _ = self.obtain_data()
+
+        # the case studies are above the threshold, so it is raised to force
+        # the direct bilinear solve
+        monkeypatch.setattr(opt_utils, "FLOW_LP_THRESHOLD", float("inf"))
+        # cost_optimal raises if the bilinear solve is not optimal
+        cost_optimal(data)
+
+        assert "skipping linear flow model" in capsys.readouterr().out
+
+    def test_greedy_recovery_flow(self):
+        data, _, _ = self.obtain_data()
+        model = build_qcp_br(data)
+        alphaW = model.p_alphaW["R01_IN"]
+
+        for desired_cm_conc in [50, 100]:
+            greedy_recovery = max_theoretical_recovery_flow(
+                model,
+                desal_unit="R01_IN",
+                desired_cm_conc=desired_cm_conc,
+                cm_name="Li",
+            )
+            lp_recovery = _recovery_flow_lp(
+                model, "Li", desired_cm_conc * (1 - alphaW)
+            ) * (1 - alphaW)
+
+            assert greedy_recovery == pytest.approx(lp_recovery, rel=1e-4)
+
+        # no source is concentrated enough for the target
+        with pytest.raises(RuntimeError):
+            max_theoretical_recovery_flow(
+                model, desal_unit="R01_IN", desired_cm_conc=1e6, cm_name="Li"
+            )
+
+    def test_greedy_kernels(self):
+        data, _, _ = self.obtain_data()
+        model = build_qcp_br(data)
+
+        flow_gen = model.p_FGen.extract_values()
+        conc_gen = model.p_CGen.extract_values()
+        f = [flow_gen[k] * 7 for k in flow_gen]
+        c = [conc_gen[k[0], "Li", k[1]] for k in flow_gen]
+
+        for desired_cm_conc in [50, 100, 150]:
+            assert _greedy_python(f, c, desired_cm_conc) == pytest.approx(
+                _greedy_numpy(f, c, desired_cm_conc)
+            )
+
+        for kernel in [_greedy_python, _greedy_numpy]:
+            # target above every source concentration
+            assert kernel([1.0, 2.0], [10.0, 20.0], 30.0) == 0.0
+            # all sources above the target, so all the flow is taken
+            assert kernel([1.0, 2.0], [10.0, 20.0], 5.0) == pytest.approx(3.0)
+            # the last source is only taken partially
+            assert kernel([1.0, 1.0], [30.0, 10.0], 20.0) == pytest.approx(2.0)
+            assert kernel([1.0, 2.0], [30.0, 10.0], 20.0) == pytest.approx(2.0)
+            # no sources
+            assert kernel([], [], 10.0) == 0.0
+
+    def test_infeasible_dump(self, tmp_path, monkeypatch):
+        data, _, _ = self.obtain_data()
+        model = build_qcp_br(data)
+        monkeypatch.chdir(tmp_path)
+
+        # nothing is written unless asked for
+        with pytest.raises(RuntimeError):
+            _recovery_flow_lp(model, "Li", 1e6)
+        assert list(tmp_path.iterdir()) == []
+
+        dump_dir = tmp_path / "dump"
+        dump_dir.mkdir()
+        with pytest.raises(RuntimeError):
+            _recovery_flow_lp(model, "Li", 1e6, dump_dir=dump_dir)
+        assert list(tmp_path.iterdir()) == [dump_dir]
+        assert any(f.name.startswith("recovery_flow_lp") for f in dump_dir.iterdir())
+
+    def test_dump_infeasible_nonlinear(self, tmp_path):
+        m = pyo.ConcreteModel()
+        m.x = pyo.Var(bounds=(0, 1))
+        m.y = pyo.Var(bounds=(0, 1))
+        m.c = pyo.Constraint(expr=m.x * m.y == 2)
+        m.obj = pyo.Objective(expr=m.x)
+
+        # no IIS is computed for the bilinear model, whatever the solvers
+        fname = _dump_infeasible(m, "bilinear", tmp_path)
+        assert fname.endswith("bilinear_infeasible.nl")
+        assert (tmp_path / "bilinear_infeasible.nl").exists()
+
+    def test_tighten_bounds(self, monkeypatch):
+        def build(ub=10):
+            m = pyo.ConcreteModel()
+            m.x = pyo.Var(bounds=(0, ub))
+            m.y = pyo.Var(bounds=(0, None))
+            m.c = pyo.Constraint(expr=m.x + m.y == 5)
+            m.d = pyo.Constraint(expr=m.y >= 1)
+            return m
+
+        # the module cache is replaced for the test
+        cache = {}
+        monkeypatch.setattr(opt_utils, "_FBBT_BOUNDS", cache)
+        m = _tighten_bounds(build(), "fbbt_test")
+        assert m.x.bounds == pytest.approx((0, 4))
+        assert m.y.bounds == pytest.approx((1, 5))
+
+        # the cached bounds are restored on the same model
+        m = _tighten_bounds(build(), "fbbt_test")
+        assert m.y.bounds == pytest.approx((1, 5))
+        assert len(cache) == 1
+
+        # but not when the active constraints differ
+        m = build()
+        m.c.deactivate()
+        m = _tighten_bounds(m, "fbbt_test")
+        assert m.x.bounds == (0, 10)
+        assert m.y.bounds == pytest.approx((1, None))
+        assert len(cache) == 2
+
+        # bounds are left as they were on an infeasible model
+        m = build()
+        m.e = pyo.Constraint(expr=m.x >= 20)
+        m = _tighten_bounds(m, "fbbt_infeasible")
+        assert m.x.bounds == (0, 10)
+        assert m.y.bounds == (0, None)
+
+        for i in range(2 * _FBBT_CACHE_SIZE):
+            _tighten_bounds(build(), i)
+        assert len(cache) == _FBBT_CACHE_SIZE
+
+    def test_init_concentrations(self):
+        data, _, _ = self.obtain_data()
+        model = self.linear_flow_model(data)
+
+        def residual(m):
+            return sum(
+                abs(pyo.value(c.body) - pyo.value(c.upper))
+                for c in m.component_data_objects(pyo.Constraint, active=True)
+                if c.equality
+            )
+
+        before = residual(model)
+        model = _init_concentrations(model)
+        assert residual(model) < 0.1 * before
+
     @pytest.mark.slow
     def test_desal_install(self):
         _, df_sets, df_parameters = self.obtain_data()